@@ -1,21 +1,14 @@
 #!/bin/env python3
 import argparse
+import array
 import collections
+import functools
+import mmap
 import re
+import struct
 import sys
-
-# https://devicetree-specification.readthedocs.io/en/v0.3/flattened-format.html#header
-# struct fdt_header
-HEADER_MAGIC = 0
-HEADER_TOTALSIZE = 4
-HEADER_OFF_DT_STRUCT = 8
-HEADER_OFF_DT_STRINGS = 12
-HEADER_OFF_MEM_RSVMAP = 16
-HEADER_VERSION = 20
-HEADER_LAST_COMP_VERSION = 24
-HEADER_BOOT_CPUID_PHYS = 28
-HEADER_SIZE_DT_STRINGS = 32
-HEADER_SIZE_DT_STRUCT = 36
+import textwrap
+import typing
 
 # https://devicetree-specification.readthedocs.io/en/v0.3/flattened-format.html#structure-block
 FDT_BEGIN_NODE = 1
@@ -32,37 +25,27 @@ TOKEN_TYPE_TO_STRING = {
     FDT_END: "END",
 }
 
-BeginNodeToken = collections.namedtuple("BeginNodeToken", "type, name, path")
-EndNodeToken = collections.namedtuple("EndNodeToken", "type")
-PropToken = collections.namedtuple("PropToken", "type, name, value")
-NopToken = collections.namedtuple("NopToken", "type")
-EndToken = collections.namedtuple("EndToken", "type")
+# Tokens are plain (type, name, data) tuples, the same shape for every type:
+#   (FDT_BEGIN_NODE, name, path)
+#   (FDT_PROP, name, value)
+#   (FDT_END_NODE | FDT_NOP | FDT_END, None, None)
 
 
-def read_uint32(buf: bytes) -> int:
-    # This is not the same thing as int.from_bytes(). If the sign bit is set, it raises an
-    # exception. That means it can only parse numbers up to 2^31-1.
+# Big-endian readers. _U64 returns a 1-tuple, hence the [0] at call sites.
+_U32_STRUCT = struct.Struct(">I")
+_U64 = struct.Struct(">Q").unpack_from
 
-    ret = (buf[0] << 24) + (buf[1] << 16) + (buf[2] << 8) + (buf[3] << 0)
-    assert ret == int.from_bytes(buf[:4])
-    return ret
 
+# The DTB is either read into memory (stdin, unmappable files) or mapped.
+Buffer = typing.Union[bytes, mmap.mmap]
 
-def read_uint64(buf: bytes) -> int:
-    ret = (
-        (buf[0] << 56)
-        + (buf[1] << 48)
-        + (buf[2] << 40)
-        + (buf[3] << 32)
-        + (buf[4] << 24)
-        + (buf[5] << 16)
-        + (buf[6] << 8)
-        + (buf[7] << 0)
-    )
-    assert ret == int.from_bytes(buf[:8])
-    return ret
+# https://devicetree-specification.readthedocs.io/en/v0.3/devicetree-basics.html#node-names
+_NODE_NAME_RE = re.compile(r"^[0-9a-zA-Z,._+\-]{1,31}(@[0-9a-zA-Z,._+\-]+)?$")
 
 
+# https://devicetree-specification.readthedocs.io/en/v0.3/flattened-format.html#header
+# struct fdt_header, ten big-endian u32 fields in on-disk order.
+_HEADER_STRUCT = struct.Struct(">10I")
 Header = collections.namedtuple(
     "Header",
     "magic, totalsize, off_dt_struct, off_dt_strings, off_mem_rsvmap, version, "
@@ -70,25 +53,13 @@ Header = collections.namedtuple(
 )
 
 
-def get_header(do_debug: bool, buf: bytes):
-    def get(off: int):
-        return read_uint32(buf[off : off + 4])
-
-    hdr = Header(
-        magic=get(HEADER_MAGIC),
-        totalsize=get(HEADER_TOTALSIZE),
-        off_dt_struct=get(HEADER_OFF_DT_STRUCT),
-        off_dt_strings=get(HEADER_OFF_DT_STRINGS),
-        off_mem_rsvmap=get(HEADER_OFF_MEM_RSVMAP),
-        version=get(HEADER_VERSION),
-        last_comp_version=get(HEADER_LAST_COMP_VERSION),
-        boot_cpuid_phys=get(HEADER_BOOT_CPUID_PHYS),
-        size_dt_strings=get(HEADER_SIZE_DT_STRINGS),
-        size_dt_struct=get(HEADER_SIZE_DT_STRUCT),
-    )
+def get_header(do_debug: bool, buf: Buffer):
+    assert len(buf) >= _HEADER_STRUCT.size, "file is too small for a DTB header"
+    hdr = Header(*_HEADER_STRUCT.unpack_from(buf, 0))
 
-    for field in hdr._fields:
-        debug_print(do_debug, field, hex(hdr._asdict()[field]))
+    if do_debug:
+        for field, value in hdr._asdict().items():
+            debug_print(do_debug, field, hex(value))
 
     assert hdr.magic == 0xD00DFEED
     assert hdr.totalsize == len(buf)
@@ -109,21 +80,60 @@ def get_header(do_debug: bool, buf: bytes):
     return hdr
 
 
-def get_reserve_entries(buf: bytes, hdr: Header):
+def parse_dtb(do_debug: bool, buf: Buffer, hdr: Header):
+    # Single front-to-back walk: the memory reservation block sits right before
+    # the structure block, whose tokens are streamed straight into the tree.
+    reserve_entries = []
     for off in range(hdr.off_mem_rsvmap, hdr.off_dt_struct, 16):
-        address = read_uint64(buf[off : off + 8])
-        size = read_uint64(buf[off + 8 : off + 16])
+        address = _U64(buf, off)[0]
+        size = _U64(buf, off + 8)[0]
         if address == 0 and size == 0:
             break
-        yield (address, size)
+        reserve_entries.append((address, size))
+
+    root, nodes_by_path = build_tree(get_structure_tokens(do_debug, buf, hdr))
+    return reserve_entries, root, nodes_by_path
+
+
+def get_structure_tokens(do_debug: bool, buf: Buffer, hdr: Header):
+    tokens = _parse_structure(buf, hdr)
+    # Decide once rather than per token: the parser itself never looks at
+    # do_debug, the extra checks and tracing are layered on top.
+    if do_debug:
+        tokens = _debug_tokens(tokens)
+    return tokens
 
 
-def get_structure_tokens(do_debug: bool, buf: bytes, hdr: Header):
+def _debug_tokens(tokens):
+    for token in tokens:
+        token_type, name, data = token
+        if token_type == FDT_BEGIN_NODE and data != "/":
+            assert _NODE_NAME_RE.match(name), f"invalid node name {name!r}"
+
+        type = TOKEN_TYPE_TO_STRING[token_type]
+        debug_print(True, f"token {type}: {token}")
+
+        yield token
+
+
+def _parse_structure(buf: Buffer, hdr: Header):
+    # Decode the whole structure block as big-endian u32 words in one go. Token
+    # headers are then array lookups; `off` stays an absolute offset into buf.
+    mv = memoryview(buf)
+    struct_end = hdr.off_dt_struct + hdr.size_dt_struct
+    words = array.array("I")
+    assert words.itemsize == 4
+    words.frombytes(mv[hdr.off_dt_struct : struct_end - hdr.size_dt_struct % 4])
+    if sys.byteorder == "little":
+        words.byteswap()
+
     off = hdr.off_dt_struct
     node_depth = 0
-    parent_nodes = []
-    while off < hdr.off_dt_strings and off < hdr.off_dt_struct + hdr.size_dt_struct:
-        token_type = read_uint32(buf[off : off + 4])
+    # Full path of each currently open node, root first.
+    path_stack = []
+    prop_names = {}
+    while off < hdr.off_dt_strings and off < struct_end:
+        token_type = words[(off - hdr.off_dt_struct) >> 2]
         off += 4
 
         # TODO: assert that if a node has no reg it has no unit-address
@@ -131,94 +141,75 @@ def get_structure_tokens(do_debug: bool, buf: bytes, hdr: Header):
         # TODO: assert that props are before child nodes
 
         if token_type == FDT_BEGIN_NODE:
-            name_len = buf[off:].find(b"\0")
-            name = buf[off : off + name_len].decode()
-            off += name_len + 4 - name_len % 4
-
-            parent_nodes.append(name)
+            end = buf.find(b"\0", off)
+            assert end >= 0
+            name = buf[off:end].decode()
+            # Skip the name and its NUL terminator, then pad to 4 bytes.
+            off = (end + 1 + 3) & ~3
 
             if node_depth == 0:
                 assert name == "", "root node must NOT have a name"
                 path = "/"
             else:
-                assert re.match(
-                    r"^[0-9a-zA-Z,\._\+\-]{1,31}(@[0-9a-zA-Z,\._\+\-]+)?$", name
+                parent_path = path_stack[-1]
+                # Interned, like symbol targets, so that path lookups in
+                # generate_html() compare by identity.
+                path = sys.intern(
+                    ("" if parent_path == "/" else parent_path) + "/" + name
                 )
-                path = "/".join(parent_nodes)
+            path_stack.append(path)
 
-            token = BeginNodeToken(type=token_type, name=name, path=path)
+            token = (FDT_BEGIN_NODE, name, path)
             node_depth += 1
         elif token_type == FDT_END_NODE:
-            token = EndNodeToken(type=token_type)
-            parent_nodes.pop()
+            token = (FDT_END_NODE, None, None)
+            path_stack.pop()
             node_depth -= 1
             assert node_depth >= 0
         elif token_type == FDT_PROP:
             assert node_depth > 0
 
-            prop_len = read_uint32(buf[off : off + 4])
-            name_off = read_uint32(buf[off + 4 : off + 8])
+            word_idx = (off - hdr.off_dt_struct) >> 2
+            prop_len = words[word_idx]
+            name_off = words[word_idx + 1]
             off += 8
 
-            name_buf = buf[hdr.off_dt_strings + name_off :]
-            name = name_buf[: name_buf.find(b"\0")].decode()
+            # Property names are shared by many nodes; decode each one once.
+            name = prop_names.get(name_off)
+            if name is None:
+                name_start = hdr.off_dt_strings + name_off
+                end = buf.find(b"\0", name_start)
+                assert end >= 0
+                name = buf[name_start:end].decode()
+                prop_names[name_off] = name
 
-            value = buf[off : off + prop_len]
-            off += prop_len
-            if prop_len % 4 != 0:
-                off += 4 - prop_len % 4
+            value = bytes(mv[off : off + prop_len])
+            off = (off + prop_len + 3) & ~3
 
-            token = PropToken(token_type, name, value)
+            token = (FDT_PROP, name, value)
         elif token_type == FDT_NOP:
-            token = NopToken(token_type)
+            token = (FDT_NOP, None, None)
         elif token_type == FDT_END:
-            assert off == hdr.off_dt_struct + hdr.size_dt_struct
+            assert off == struct_end
             assert node_depth == 0
-            token = EndToken(token_type)
+            token = (FDT_END, None, None)
         else:
             assert False, f"unknown token type {token_type}"
 
-        if do_debug:
-            type = TOKEN_TYPE_TO_STRING[token_type]
-            debug_print(do_debug, f"token {type}: {token}")
-
         yield token
 
 
-def get_props_of_node(tokens, path):
-    if isinstance(path, bytes):
-        index = path.find(b"\0")
-        assert index >= 0
-        path = path[:index].decode()
-
-    path_stack = []
-    for token in tokens:
-        if token.type == FDT_BEGIN_NODE:
-            path_stack.append(token.path)
-        elif token.type == FDT_END_NODE:
-            path_stack.pop()
-
-        if token.type == FDT_PROP and path_stack[-1] == path:
-            yield token
-
-
-def get_symbols(tokens):
-    res = {}
-    for prop in get_props_of_node(tokens, "/__symbols__"):
-        index = prop.value.find(b"\0")
-        assert index >= 0
-        res[prop.name] = prop.value[:index].decode()
-    return res
-
-
+# Identical values are common across nodes (compatible, status, *-names...).
+@functools.lru_cache(maxsize=4096)
 def pretty_value_bytes(value, prop_name):
-    # Try to parse as string array.
-    parts = value.split(b"\0")
-    heuristic = len(parts) != 0 and parts[-1] == b"" and b"" not in parts[:-1]
+    # Try to parse as string array: NUL-terminated, no empty string inside.
+    heuristic = (
+        value.endswith(b"\0") and not value.startswith(b"\0") and b"\0\0" not in value
+    )
     if heuristic or prop_name.endswith("-names"):
         try:
             pretty_strings = []
-            for string in parts[:-1]:
+            for string in value.split(b"\0")[:-1]:
                 pretty_strings.append(f'"{string.decode()}"')
             return ", ".join(pretty_strings)
         except UnicodeDecodeError:
@@ -226,37 +217,52 @@ def pretty_value_bytes(value, prop_name):
 
     # Special rendering for 4-bytes multiples.
     if len(value) % 4 == 0:
-        res = []
-        for i in range(0, len(value), 4):
-            res.append(hex(read_uint32(value[i : i + 4])))
-        return " ".join(res)
+        return " ".join([hex(word) for (word,) in _U32_STRUCT.iter_unpack(value)])
 
     # Ugly rendering for the remaining (mostly MAC addresses)?
     return f"0x{value.hex()}"
 
 
+# Only text content is escaped, never attribute values, so quotes can stay.
+_HTML_ESC = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
 Node = collections.namedtuple("Node", "name, path, props, children")
 
 
-def to_graph(tokens):
+def build_tree(tokens):
+    # Build the node tree in a single pass, so the tokens can be streamed rather
+    # than kept around in a list. Nodes are also indexed by path for lookups.
     stack = []
-    for t in tokens:
-        if t.type == FDT_BEGIN_NODE:
-            stack.append(Node(t.name, t.path, {}, []))
-        elif t.type == FDT_END_NODE:
+    nodes_by_path = {}
+    for token_type, name, data in tokens:
+        if token_type == FDT_BEGIN_NODE:
+            node = Node(name, data, {}, [])
+            nodes_by_path[data] = node
+            stack.append(node)
+        elif token_type == FDT_END_NODE:
             if len(stack) >= 2:
                 stack[-2].children.append(stack[-1])
             if len(stack) != 1:  # keep the root element
                 stack.pop()
-        elif t.type == FDT_PROP:
-            stack[-1].props[t.name] = t.value
-            pass
+        elif token_type == FDT_PROP:
+            stack[-1].props[name] = data
+
+    return stack[0], nodes_by_path
+
 
-    return stack[0]
+def get_symbols(nodes_by_path):
+    res = {}
+    symbols_node = nodes_by_path.get("/__symbols__")
+    if symbols_node is None:
+        return res
+    for name, value in symbols_node.props.items():
+        index = value.find(b"\0")
+        assert index >= 0
+        res[name] = sys.intern(value[:index].decode())
+    return res
 
 
-def generate_html(tokens, reserve_entries, f):
-    f.write("""
+_HTML_PREAMBLE = textwrap.dedent("""\
         <!DOCTYPE html>
         <html>
         <head>
@@ -268,41 +274,9 @@ def generate_html(tokens, reserve_entries, f):
 
         <main>
         <section id="tree">
-    """)
-
-    symbols = get_symbols(tokens)
-    path_to_symbol_mapping = {v: k for k, v in symbols.items()}
-
-    def dump_html_node(node):
-        f.write('<div class="node">')
-
-        f.write('<div class="node-header">')
-        name = node.name or "/"
-        if symbol := path_to_symbol_mapping.get(node.path):
-            name = f"{symbol}: {name}"
-        f.write(f'<p class="node-name">{name}</p>')
-        if node.props:
-            f.write('<ul class="node-props">')
-            for prop, value in node.props.items():
-                if value == b"":
-                    f.write(f"<li>{prop};</li>")
-                else:
-                    value = pretty_value_bytes(value, prop)
-                    f.write(f"<li>{prop}: {value};</li>")
-            f.write("</ul>")
-        f.write("</div>")
-
-        if node.children:
-            f.write('<div class="children">')
-            for child in node.children:
-                dump_html_node(child)
-            f.write("</div>")
-        f.write("</div>")
+    """).encode()
 
-    root = to_graph(tokens)
-    dump_html_node(root)
-
-    f.write("""
+_HTML_POSTAMBLE = textwrap.dedent("""\
         </section>
         </main>
         </body>
@@ -337,7 +311,58 @@ def generate_html(tokens, reserve_entries, f):
         })
         </script>
         </html>
-    """)
+    """).encode()
+
+
+def generate_html(root, symbols, reserve_entries, f):
+    f.write(_HTML_PREAMBLE)
+
+    path_to_symbol_mapping = {v: k for k, v in symbols.items()}
+
+    # Walk the tree iteratively, with plain strings on the stack standing for
+    # closing tags, and write the whole tree with a single call. f is a binary
+    # file: the tree is encoded once at the end.
+    out = []
+    append = out.append
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, str):
+            append(node)
+            continue
+
+        name = (node.name or "/").translate(_HTML_ESC)
+        if symbol := path_to_symbol_mapping.get(node.path):
+            name = symbol.translate(_HTML_ESC) + ": " + name
+        # Adjacent fixed markup is merged into as few fragments as possible.
+        header = (
+            '<div class="node"><div class="node-header"><p class="node-name">'
+            + name
+            + "</p>"
+        )
+        if node.props:
+            append(header + '<ul class="node-props">')
+            for prop, value in node.props.items():
+                prop_html = prop.translate(_HTML_ESC)
+                if value == b"":
+                    append("<li>" + prop_html + ";</li>")
+                else:
+                    value = pretty_value_bytes(value, prop).translate(_HTML_ESC)
+                    append("<li>" + prop_html + ": " + value + ";</li>")
+            append("</ul></div>")
+        else:
+            append(header + "</div>")
+
+        if node.children:
+            append('<div class="children">')
+            stack.append("</div></div>")
+            stack.extend(reversed(node.children))
+        else:
+            append("</div>")
+
+    f.write("".join(out).encode())
+
+    f.write(_HTML_POSTAMBLE)
 
 
 def debug_print(do_debug: bool, *args):
@@ -356,23 +381,30 @@ def main():
     args = parser.parse_args()
     do_debug = args.debug
 
-    # Get buffer from file/stdin.
+    # Get buffer from file/stdin. Files are mapped rather than read when
+    # possible; mmap objects support the bytes operations the parser uses.
     if args.dtb_filepath == "-":
         buf = sys.stdin.buffer.read()
     else:
         with open(args.dtb_filepath, "rb") as f:
-            buf = f.read()
+            try:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):  # empty file, pipe, ...
+                buf = f.read()
 
     hdr = get_header(do_debug, buf)
 
-    reserve_entries = list(get_reserve_entries(buf, hdr))
-    tokens = list(get_structure_tokens(do_debug, buf, hdr))
+    reserve_entries, root, nodes_by_path = parse_dtb(do_debug, buf, hdr)
+    symbols = get_symbols(nodes_by_path)
+
+    if isinstance(buf, mmap.mmap):
+        buf.close()
 
     if args.output == "-":
-        generate_html(tokens, reserve_entries, sys.stdout)
+        generate_html(root, symbols, reserve_entries, sys.stdout.buffer)
     else:
-        with open(args.output, "w") as html_file:
-            generate_html(tokens, reserve_entries, html_file)
+        with open(args.output, "wb") as html_file:
+            generate_html(root, symbols, reserve_entries, html_file)
 
 
 if __name__ == "__main__":